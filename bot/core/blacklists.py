@@ -16,7 +16,7 @@ def guild_blacklist():
     Get the guild blacklist
     """
     rows = tables.global_guild_blacklist.select_where()
-    return set(row['guildid'] for row in rows)
+    return frozenset(row['guildid'] for row in rows)
 
 
 @cachetools.func.ttl_cache(ttl=300)
@@ -25,7 +25,7 @@ def user_blacklist():
     Get the global user blacklist.
     """
     rows = tables.global_user_blacklist.select_where()
-    return set(row['userid'] for row in rows)
+    return frozenset(row['userid'] for row in rows)
 
 
 @module.init_task
@@ -181,7 +181,7 @@ class Lion:
         """
         if 'sessions' not in client.objects:
             raise ValueError("Cannot retrieve session before Study module is initialised!")
-        return client.objects['sessions'][self.guildid].get(self.userid, None)
+        return client.objects['sessions'].get(self.key, None)
 
     @property
     def timezone(self):
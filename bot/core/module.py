@@ -14,8 +14,7 @@ module = LionModule("Core")
 
 async def _lion_sync_loop():
     while True:
-        while not client.is_ready():
-            await asyncio.sleep(1)
+        await client.wait_until_ready()
 
         client.log(
             "Running lion data sync.",
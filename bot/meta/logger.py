@@ -71,7 +71,8 @@ def log(message, context="GLOBAL", level=logging.INFO, post=True):
         ))
 
     # Fire and forget to the channel logger, if it is set up
-    if post and client.is_ready():
+    # Only messages of at least INFO level are posted
+    if post and level >= logging.INFO and client.is_ready():
         asyncio.ensure_future(live_log(message, context, level))
 
 
@@ -1,14 +1,14 @@
-import re
 import datetime
 import discord
 import asyncio
-import contextlib
+import weakref
+from cachetools import TTLCache
 from cmdClient.checks import in_guild
 
 from meta import client
 from utils.lib import multiselect_regex, parse_ranges, prop_tabulate
 from data import NOTNULL
-from data.conditions import GEQ, LEQ
+from data.conditions import GEQ
 
 from .module import module
 from .lib import utc_now
@@ -21,8 +21,7 @@ from .data import accountability_members, accountability_member_info, accountabi
 hint_icon = "https://projects.iamcal.com/emoji-data/img-apple-64/1f4a1.png"
 
 
-def time_format(time):
-    diff = (time - utc_now()).total_seconds()
+def time_format(time, diff):
     if diff < 0:
         diffstr = "`Right Now!!`"
     elif diff < 600:
@@ -33,32 +32,90 @@ def time_format(time):
         hours = round(diff / 3600)
         diffstr = "`In {:>2} hour{}`".format(hours, 's' if hours > 1 else ' ')
 
+    timestamp = time.timestamp()
     return "{} | <t:{:.0f}:t> - <t:{:.0f}:t>".format(
         diffstr,
-        time.timestamp(),
-        time.timestamp() + 3600,
+        timestamp,
+        timestamp + 3600,
     )
 
 
-user_locks = {}  # Map userid -> ctx
+# Short-lived cache of upcoming slot attendee counts
+_attendee_cache = TTLCache(1000, ttl=30)  # Map guildid -> {start_at: num}
 
 
-@contextlib.contextmanager
-def ensure_exclusive(ctx):
+def get_attendees(guildid):
     """
-    Cancel any existing exclusive contexts for the author.
+    Get the attendee counts for the upcoming slots in the given guild.
+    Results are cached for a short time, and invalidated on booking changes.
     """
-    old_ctx = user_locks.pop(ctx.author.id, None)
-    if old_ctx:
-        [task.cancel() for task in old_ctx.tasks]
+    attendees = _attendee_cache.get(guildid, None)
+    if attendees is None:
+        rows = accountability_member_info.select_where(
+            guildid=guildid,
+            userid=NOTNULL,
+            start_at=GEQ(utc_now()),
+            select_columns=(
+                'slotid',
+                'start_at',
+                'COUNT(*) as num'
+            ),
+            _extra="GROUP BY start_at, slotid"
+        )
+        attendees = _attendee_cache[guildid] = {row['start_at']: row['num'] for row in rows}
+    return attendees
+
+
+async def gather_requests(*coros):
+    """
+    Run the given Discord requests concurrently, ignoring any HTTP failures.
+    """
+    results = await asyncio.gather(*coros, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception) and not isinstance(result, discord.HTTPException):
+            raise result
+
+
+_user_locks = weakref.WeakValueDictionary()  # Map userid -> asyncio.Lock
+_menu_tasks = {}  # Map userid -> Task waiting for a menu reply
+_superseded_menus = set()  # Reply tasks cancelled because the user opened a newer menu
 
-    user_locks[ctx.author.id] = ctx
+
+def user_lock(userid):
+    """
+    Get the lock guarding schedule changes for the given user.
+    """
+    lock = _user_locks.get(userid, None)
+    if lock is None:
+        lock = _user_locks[userid] = asyncio.Lock()
+    return lock
+
+
+async def wait_for_reply(ctx, check, timeout):
+    """
+    Wait for the author to reply to a menu, closing any other menu they have open.
+    Returns the reply message, or `None` if the menu was closed.
+    """
+    old_task = _menu_tasks.pop(ctx.author.id, None)
+    if old_task is not None:
+        _superseded_menus.add(old_task)
+        old_task.cancel()
+
+    task = _menu_tasks[ctx.author.id] = asyncio.create_task(
+        ctx.client.wait_for('message', check=check, timeout=timeout)
+    )
     try:
-        yield
+        return await task
+    except asyncio.CancelledError:
+        if task in _superseded_menus:
+            # Closed by a newer menu
+            return None
+        # The command itself was cancelled
+        raise
     finally:
-        new_ctx = user_locks.get(ctx.author.id, None)
-        if new_ctx and new_ctx.msg.id == ctx.msg.id:
-            user_locks.pop(ctx.author.id)
+        _superseded_menus.discard(task)
+        if _menu_tasks.get(ctx.author.id, None) is task:
+            _menu_tasks.pop(ctx.author.id)
 
 
 @module.cmd(
@@ -86,10 +143,12 @@ async def cmd_rooms(ctx):
     if not ctx.guild_settings.accountability_category.value:
         return await ctx.error_reply("The scheduled session system isn't set up!")
 
+    now = utc_now()
+
     # First grab the sessions the member is booked in
     joined_rows = accountability_member_info.select_where(
         userid=ctx.author.id,
-        start_at=GEQ(utc_now()),
+        start_at=GEQ(now),
         _extra="ORDER BY start_at ASC"
     )
 
@@ -99,7 +158,7 @@ async def cmd_rooms(ctx):
 
         # Show unbooking menu
         lines = [
-            "`[{:>2}]` | {}".format(i, time_format(row['start_at']))
+            "`[{:>2}]` | {}".format(i, time_format(row['start_at'], (row['start_at'] - now).total_seconds()))
             for i, row in enumerate(joined_rows)
         ]
         out_msg = await ctx.reply(
@@ -123,76 +182,83 @@ async def cmd_rooms(ctx):
 
         def check(msg):
             valid = msg.channel == ctx.ch and msg.author == ctx.author
-            valid = valid and (re.search(multiselect_regex, msg.content) or msg.content.lower() == 'c')
+            valid = valid and (msg.content in ('c', 'C') or multiselect_regex.search(msg.content))
             return valid
 
-        with ensure_exclusive(ctx):
-            try:
-                message = await ctx.client.wait_for('message', check=check, timeout=60)
-            except asyncio.TimeoutError:
-                try:
-                    await out_msg.edit(
-                        content=None,
-                        embed=discord.Embed(
-                            description="Cancel menu timed out, no scheduled sessions were cancelled.",
-                            colour=discord.Colour.red()
-                        )
+        try:
+            message = await wait_for_reply(ctx, check, timeout=60)
+        except asyncio.TimeoutError:
+            await gather_requests(
+                out_msg.edit(
+                    content=None,
+                    embed=discord.Embed(
+                        description="Cancel menu timed out, no scheduled sessions were cancelled.",
+                        colour=discord.Colour.red()
                     )
-                    await out_msg.clear_reactions()
-                except discord.HTTPException:
-                    pass
-                return
+                ),
+                out_msg.clear_reactions()
+            )
+            return
+        if message is None:
+            # Menu was replaced by a newer one
+            return
 
-            try:
-                await out_msg.delete()
-                await message.delete()
-            except discord.HTTPException:
-                pass
+        async with user_lock(ctx.author.id):
+            await gather_requests(out_msg.delete(), message.delete())
 
             if message.content.lower() == 'c':
                 return
 
             to_cancel = [
                 joined_rows[index]
-                for index in parse_ranges(message.content) if index < len(joined_rows)
+                for index in dict.fromkeys(parse_ranges(message.content)) if index < len(joined_rows)
             ]
             if not to_cancel:
                 return await ctx.error_reply("No valid sessions selected for cancellation.")
-            elif any(row['start_at'] < utc_now() for row in to_cancel):
+
+            now = utc_now()
+            if any(row['start_at'] < now for row in to_cancel):
                 return await ctx.error_reply("You can't cancel a running session!")
 
             slotids = [row['slotid'] for row in to_cancel]
+            slotid_set = set(slotids)
+            guildids = set(row['guildid'] for row in to_cancel)
             async with room_lock:
                 deleted = accountability_members.delete_where(
                     userid=ctx.author.id,
                     slotid=slotids
                 )
+                for guildid in guildids:
+                    _attendee_cache.pop(guildid, None)
 
                 # Handle case where the slot has already opened
                 # TODO: Possible race condition if they open over the hour border? Might never cancel
-                for row in to_cancel:
-                    aguild = AGuild.cache.get(row['guildid'], None)
+                opened_slots = []
+                for guildid in guildids:
+                    aguild = AGuild.cache.get(guildid, None)
                     if aguild and aguild.upcoming_slot and aguild.upcoming_slot.data:
-                        if aguild.upcoming_slot.data.slotid in slotids:
+                        if aguild.upcoming_slot.data.slotid in slotid_set:
                             aguild.upcoming_slot.members.pop(ctx.author.id, None)
-                            if aguild.upcoming_slot.channel:
-                                try:
-                                    await aguild.upcoming_slot.channel.set_permissions(
-                                        ctx.author,
-                                        overwrite=None
-                                    )
-                                except discord.HTTPException:
-                                    pass
-                            await aguild.upcoming_slot.update_status()
+                            opened_slots.append(aguild.upcoming_slot)
                             break
 
+            # Update the opened slots after releasing the lock, since these are Discord requests
+            if opened_slots:
+                await gather_requests(*(
+                    slot.channel.set_permissions(ctx.author, overwrite=None)
+                    for slot in opened_slots if slot.channel
+                ))
+                for slot in opened_slots:
+                    await slot.update_status()
+
             ctx.alion.addCoins(sum(row[2] for row in deleted))
 
-            remaining = [row for row in joined_rows if row['slotid'] not in slotids]
+            remaining = [row for row in joined_rows if row['slotid'] not in slotid_set]
             if not remaining:
                 await ctx.embed_reply("Cancelled all your upcoming scheduled sessions!")
             else:
-                next_booked_time = min(row['start_at'] for row in remaining)
+                # Booked sessions are ordered by start time
+                next_booked_time = remaining[0]['start_at']
                 if len(to_cancel) > 1:
                     await ctx.embed_reply(
                         "Cancelled `{}` upcoming sessions!\nYour next session is at <t:{:.0f}>.".format(
@@ -211,35 +277,25 @@ async def cmd_rooms(ctx):
     elif command == 'book':
         # Show booking menu
         # Get attendee count
-        rows = accountability_member_info.select_where(
-            guildid=ctx.guild.id,
-            userid=NOTNULL,
-            select_columns=(
-                'slotid',
-                'start_at',
-                'COUNT(*) as num'
-            ),
-            _extra="GROUP BY start_at, slotid"
-        )
-        attendees = {row['start_at']: row['num'] for row in rows}
-        attendee_pad = max((len(str(num)) for num in attendees.values()), default=1)
+        attendees = get_attendees(ctx.guild.id)
+        attendee_pad = len(str(max(attendees.values(), default=0)))
 
         # Build lines
         already_joined_times = set(row['start_at'] for row in joined_rows)
-        start_time = utc_now().replace(minute=0, second=0, microsecond=0)
-        times = (
-            start_time + datetime.timedelta(hours=n)
-            for n in range(1, 25)
-        )
-        times = [
-            time for time in times
-            if time not in already_joined_times and (time - utc_now()).total_seconds() > 660
-        ]
+        start_time = now.replace(minute=0, second=0, microsecond=0)
+        times = []
+        time_strs = {}
+        for n in range(1, 25):
+            time = start_time + datetime.timedelta(hours=n)
+            diff = (time - now).total_seconds()
+            if time not in already_joined_times and diff > 660:
+                times.append(time)
+                time_strs[time] = time_format(time, diff)
         lines = [
             "`[{num:>2}]` | `{count:>{count_pad}}` attending | {time}".format(
                 num=i,
                 count=attendees.get(time, 0), count_pad=attendee_pad,
-                time=time_format(time),
+                time=time_strs[time],
             )
             for i, time in enumerate(times)
         ]
@@ -267,42 +323,42 @@ async def cmd_rooms(ctx):
 
         def check(msg):
             valid = msg.channel == ctx.ch and msg.author == ctx.author
-            valid = valid and (re.search(multiselect_regex, msg.content) or msg.content.lower() == 'c')
+            valid = valid and (msg.content in ('c', 'C') or multiselect_regex.search(msg.content))
             return valid
 
-        with ensure_exclusive(ctx):
-            try:
-                message = await ctx.client.wait_for('message', check=check, timeout=30)
-            except asyncio.TimeoutError:
-                try:
-                    await out_msg.edit(
-                        content=None,
-                        embed=discord.Embed(
-                            description="Booking menu timed out, no sessions were booked.",
-                            colour=discord.Colour.red()
-                        )
+        try:
+            message = await wait_for_reply(ctx, check, timeout=30)
+        except asyncio.TimeoutError:
+            await gather_requests(
+                out_msg.edit(
+                    content=None,
+                    embed=discord.Embed(
+                        description="Booking menu timed out, no sessions were booked.",
+                        colour=discord.Colour.red()
                     )
-                    await out_msg.clear_reactions()
-                except discord.HTTPException:
-                    pass
-                return
+                ),
+                out_msg.clear_reactions()
+            )
+            return
+        if message is None:
+            # Menu was replaced by a newer one
+            return
 
-            try:
-                await out_msg.delete()
-                await message.delete()
-            except discord.HTTPException:
-                pass
+        async with user_lock(ctx.author.id):
+            await gather_requests(out_msg.delete(), message.delete())
 
             if message.content.lower() == 'c':
                 return
 
             to_book = [
                 times[index]
-                for index in parse_ranges(message.content) if index < len(times)
+                for index in dict.fromkeys(parse_ranges(message.content)) if index < len(times)
             ]
             if not to_book:
                 return await ctx.error_reply("No valid sessions selected.")
-            elif any(time < utc_now() for time in to_book):
+
+            now = utc_now()
+            if any(time < now for time in to_book):
                 return await ctx.error_reply("You can't book a running session!")
             cost = len(to_book) * ctx.guild_settings.accountability_price.value
             if cost > ctx.alion.coins:
@@ -314,22 +370,14 @@ async def cmd_rooms(ctx):
                     )
                 )
 
-            # Add the member to data, creating the row if required
-            slot_rows = accountability_rooms.fetch_rows_where(
-                guildid=ctx.guild.id,
-                start_at=to_book
-            )
-            slotids = [row.slotid for row in slot_rows]
-            to_add = set(to_book).difference((row.start_at for row in slot_rows))
-            if to_add:
-                slotids.extend(row['slotid'] for row in accountability_rooms.insert_many(
-                    *((ctx.guild.id, start_at) for start_at in to_add),
-                    insert_keys=('guildid', 'start_at'),
-                ))
-            accountability_members.insert_many(
-                *((slotid, ctx.author.id, ctx.guild_settings.accountability_price.value) for slotid in slotids),
-                insert_keys=('slotid', 'userid', 'paid')
+            # Add the member to data, creating the slots if required
+            accountability_members.queries.book_slots(
+                ctx.guild.id,
+                ctx.author.id,
+                to_book,
+                ctx.guild_settings.accountability_price.value
             )
+            _attendee_cache.pop(ctx.guild.id, None)
 
             # Handle case where the slot has already opened
             # TODO: Fix this, doesn't always work
@@ -363,7 +411,7 @@ async def cmd_rooms(ctx):
                 "*If you can't attend, cancel with* `{}schedule cancel`\n\n{}"
             ).format(
                 ctx.best_prefix,
-                '\n'.join(time_format(time) for time in to_book),
+                '\n'.join(time_strs[time] for time in to_book),
             ),
             colour=discord.Colour.orange()
         ).set_footer(
@@ -391,16 +439,11 @@ async def cmd_rooms(ctx):
         # Attendance streak: `{}` days attended with no missed sessions!
         # Add explanation for first time users
 
-        # Get all slots the member has ever booked
-        history = accountability_member_info.select_where(
-            userid=ctx.author.id,
-            # start_at=LEQ(utc_now() - datetime.timedelta(hours=1)),
-            start_at=LEQ(utc_now()),
-            select_columns=("*", "(duration > 0 OR last_joined_at IS NOT NULL) AS attended"),
-            _extra="ORDER BY start_at DESC"
-        )
+        # Get the member's daily attendance statistics
+        timezone = ctx.alion.settings.timezone.value
+        days = accountability_member_info.queries.user_attendance_days(ctx.author.id, now, str(timezone))
 
-        if not (history or joined_rows):
+        if not (days or joined_rows):
             # First-timer information
             about = (
                 "You haven't scheduled any study sessions yet!\n"
@@ -424,67 +467,39 @@ async def cmd_rooms(ctx):
             await ctx.reply(embed=embed)
         else:
             # Build description with stats
-            if history:
+            if days:
                 # First get the counts
-                attended_count = sum(row['attended'] for row in history)
-                total_count = len(history)
-                total_duration = sum(row['duration'] for row in history)
-
-                # Add current session to duration if it exists
-                if history[0]['last_joined_at'] and (utc_now() - history[0]['start_at']).total_seconds() < 3600:
-                    total_duration += int((utc_now() - history[0]['last_joined_at']).total_seconds())
+                attended_count = 0
+                total_count = 0
+                total_duration = 0
+                for row in days:
+                    attended_count += row['attended']
+                    total_count += row['total']
+                    total_duration += row['duration']
 
                 # Calculate the streak
-                timezone = ctx.alion.settings.timezone.value
+                today = now.astimezone(timezone).date()
+                daydiff = datetime.timedelta(days=1)
 
                 streak = 0
                 current_streak = None
                 max_streak = 0
-                day_attended = None
-                date = utc_now().astimezone(timezone).replace(hour=0, minute=0, second=0, microsecond=0)
-                daydiff = datetime.timedelta(days=1)
 
-                i = 0
-                while i < len(history):
-                    row = history[i]
-                    i += 1
-                    if not row['attended']:
-                        # Not attended, streak broken
-                        pass
-                    elif row['start_at'] > date:
-                        # They attended this day
-                        day_attended = True
-                        continue
-                    elif day_attended is None:
-                        # Didn't attend today, but don't break streak
-                        day_attended = False
-                        date -= daydiff
-                        i -= 1
-                        continue
-                    elif not day_attended:
-                        # Didn't attend the day, streak broken
-                        date -= daydiff
-                        i -= 1
-                        pass
-                    else:
-                        # Attended the day
+                # Not having a session today yet doesn't break the streak
+                expected = today if days[0]['day'] == today else today - daydiff
+                for row in days:
+                    day, attended = row['day'], row['all_attended']
+                    if not attended or day != expected:
+                        # Missed a session or skipped a day, streak broken
+                        if current_streak is None:
+                            current_streak = streak
+                        streak = 0
+                    if attended:
                         streak += 1
-
-                        # Move window to the previous day and try the row again
-                        date -= daydiff
-                        day_attended = False
-                        i -= 1
-                        continue
-
                     max_streak = max(max_streak, streak)
-                    if current_streak is None:
-                        current_streak = streak
-                    streak = 0
-
-                # Handle loop exit state, i.e. the last streak
-                if day_attended:
-                    streak += 1
-                max_streak = max(max_streak, streak)
+                    expected = day - daydiff
+
+                # Handle the last streak
                 if current_streak is None:
                     current_streak = streak
 
@@ -531,7 +546,7 @@ async def cmd_rooms(ctx):
                 attendees = {
                     row['start_at']: (row['num'], row['guildid']) for row in rows
                 }
-                attendee_pad = max((len(str(num)) for num, _ in attendees.values()), default=1)
+                attendee_pad = len(str(max((num for num, _ in attendees.values()), default=0)))
 
                 # TODO: Allow cancel to accept multiselect keys as args
                 show_guild = any(guildid != ctx.guild.id for _, guildid in attendees.values())
@@ -539,19 +554,27 @@ async def cmd_rooms(ctx):
                 if show_guild:
                     for _, guildid in attendees.values():
                         if guildid not in guild_map:
-                            guild = ctx.client.get_guild(guildid)
-                            if not guild:
-                                try:
-                                    guild = await ctx.client.fetch_guild(guildid)
-                                except discord.HTTPException:
-                                    guild = None
+                            guild_map[guildid] = ctx.client.get_guild(guildid)
+
+                    # Fetch any unknown guilds concurrently
+                    unknown_ids = [guildid for guildid, guild in guild_map.items() if guild is None]
+                    if unknown_ids:
+                        fetched = await asyncio.gather(
+                            *(ctx.client.fetch_guild(guildid) for guildid in unknown_ids),
+                            return_exceptions=True
+                        )
+                        for guildid, guild in zip(unknown_ids, fetched):
+                            if isinstance(guild, discord.HTTPException):
+                                guild = None
+                            elif isinstance(guild, Exception):
+                                raise guild
                             guild_map[guildid] = guild
 
                 booked_list = '\n'.join(
                     "`{:>{}}` attendees | {} {}".format(
                         num,
                         attendee_pad,
-                        time_format(start),
+                        time_format(start, (start - now).total_seconds()),
                         "" if not show_guild else (
                             "on this server" if guildid == ctx.guild.id else "in **{}**".format(
                                 guild_map[guildid] or "Unknown"
@@ -22,13 +22,75 @@ accountability_members = RowTable(
 accountability_member_info = Table('accountability_member_info')
 accountability_open_slots = Table('accountability_open_slots')
 
-# @accountability_member_info.save_query
-# def user_streaks(userid, min_duration):
-#     with accountability_member_info.conn as conn:
-#         cursor = conn.cursor()
-#         with cursor:
-#             cursor.execute(
-#                 """
-
-#                 """
-#             )
+
+@accountability_members.save_query
+def book_slots(guildid, userid, start_times, paid):
+    """
+    Book the member into the guild slots starting at the given times, creating the slots if required.
+    Uses a single statement, and returns the new member rows.
+    """
+    with accountability_members.conn as conn:
+        with conn.cursor() as curs:
+            curs.execute(
+                """
+                WITH
+                  existing_slots AS (
+                    SELECT slotid, start_at
+                    FROM accountability_slots
+                    WHERE guildid = %(guildid)s AND start_at = ANY(%(start_times)s)
+                  ),
+                  new_slots AS (
+                    INSERT INTO accountability_slots (guildid, start_at)
+                    SELECT %(guildid)s, t.start_at
+                    FROM UNNEST(%(start_times)s::TIMESTAMPTZ[]) AS t (start_at)
+                    WHERE t.start_at NOT IN (SELECT start_at FROM existing_slots)
+                    RETURNING slotid
+                  )
+                INSERT INTO accountability_members (slotid, userid, paid)
+                SELECT slotid, %(userid)s, %(paid)s
+                FROM (
+                  SELECT slotid FROM existing_slots
+                  UNION ALL
+                  SELECT slotid FROM new_slots
+                ) AS slots
+                RETURNING *
+                """,
+                {'guildid': guildid, 'userid': userid, 'start_times': list(set(start_times)), 'paid': paid}
+            )
+            rows = curs.fetchall()
+    return accountability_members._make_rows(*rows)
+
+
+@accountability_member_info.save_query
+def user_attendance_days(userid, now, timezone):
+    """
+    Retrieve the member's attendance statistics for each day, in the given timezone,
+    on which they had scheduled sessions starting before `now`.
+    Returns rows of `(day, attended, total, duration, all_attended)`, most recent first.
+    The session `duration` is in seconds, and includes the ongoing session time.
+    """
+    with accountability_member_info.conn as conn:
+        with conn.cursor() as curs:
+            curs.execute(
+                """
+                SELECT
+                  (start_at AT TIME ZONE %(timezone)s)::DATE AS day,
+                  COUNT(*) FILTER (WHERE duration > 0 OR last_joined_at IS NOT NULL) AS attended,
+                  COUNT(*) AS total,
+                  (
+                    SUM(duration)
+                    + COALESCE(
+                      SUM(EXTRACT(EPOCH FROM %(now)s - last_joined_at))
+                      FILTER (WHERE start_at > %(now)s - INTERVAL '1 hour'),
+                      0
+                    )
+                  )::INTEGER AS duration,
+                  BOOL_AND(duration > 0 OR last_joined_at IS NOT NULL) AS all_attended
+                FROM accountability_member_info
+                WHERE userid = %(userid)s AND start_at <= %(now)s
+                GROUP BY day
+                ORDER BY day DESC
+                """,
+                {'userid': userid, 'now': now, 'timezone': timezone}
+            )
+            return curs.fetchall()
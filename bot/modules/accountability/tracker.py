@@ -293,8 +293,7 @@ async def _accountability_loop():
     Runloop in charge of executing the room update tasks at the correct times.
     """
     # Wait until ready
-    while not client.is_ready():
-        await asyncio.sleep(0.1)
+    await client.wait_until_ready()
 
     # Calculate starting next_time
     # Assume the resume logic has taken care of all events/tasks before current_time
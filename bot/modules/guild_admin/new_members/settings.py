@@ -1,5 +1,6 @@
 import datetime
 import discord
+from cachetools import LRUCache
 
 import settings
 from settings import GuildSettings, GuildSetting
@@ -231,8 +232,8 @@ class autoroles(stypes.RoleList, settings.ListData, settings.Setting):
         "If `role_persistence` is enabled, the roles will only be given the first time a user joins the server."
     )
 
-    # Flat cache, no need to expire
-    _cache = {}
+    # Flat cache, evicting the least recently used guilds
+    _cache = LRUCache(8192)
 
     @property
     def success_response(self):
@@ -263,8 +264,8 @@ class bot_autoroles(stypes.RoleList, settings.ListData, settings.Setting):
         "If `role_persistence` is enabled, the roles will only be given the first time a bot joins the server."
     )
 
-    # Flat cache, no need to expire
-    _cache = {}
+    # Flat cache, evicting the least recently used guilds
+    _cache = LRUCache(8192)
 
     @property
     def success_response(self):
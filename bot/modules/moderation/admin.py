@@ -1,4 +1,5 @@
 import discord
+from cachetools import LRUCache
 
 from settings import GuildSettings, GuildSetting
 from wards import guild_admin
@@ -96,8 +97,8 @@ class studyban_durations(settings.SettingList, settings.ListData, settings.Setti
         "Comma separated list of durations in days/hours/minutes/seconds, for example `12h, 1d, 7d, 30d`."
     )
 
-    # Flat cache, no need to expire objects
-    _cache = {}
+    # Flat cache, evicting the least recently used guilds
+    _cache = LRUCache(8192)
 
     @property
     def success_response(self):
@@ -1,4 +1,5 @@
 from collections import defaultdict
+from cachetools import LRUCache
 
 from settings import GuildSettings, GuildSetting
 from wards import guild_admin
@@ -33,8 +34,8 @@ class video_channels(settings.ChannelList, settings.ListData, settings.Setting):
         "they will also be automatically studybanned."
     )
 
-    # Flat cache, no need to expire objects
-    _cache = {}
+    # Flat cache, evicting the least recently used guilds
+    _cache = LRUCache(8192)
 
     @property
     def success_response(self):
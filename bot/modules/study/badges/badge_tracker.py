@@ -41,8 +41,7 @@ async def guild_lock(guildid):
 
 
 async def update_study_badges(full=False):
-    while not client.is_ready():
-        await asyncio.sleep(1)
+    await client.wait_until_ready()
 
     client.log(
         "Running global study badge update.".format(
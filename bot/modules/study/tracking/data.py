@@ -49,6 +49,31 @@ def close_study_session(guildid, userid):
     tables.lions._make_rows(*rows)
 
 
+@current_sessions.save_query
+def close_study_sessions(*keys):
+    """
+    Close the current sessions of each of the given `(guildid, userid)` members with a single query,
+    and update the member cache.
+    """
+    with current_sessions.conn as conn:
+        cursor = conn.cursor()
+        rows = execute_values(
+            cursor,
+            """
+            SELECT m.*
+            FROM (VALUES %s) AS t (guildid, userid),
+            LATERAL close_study_session(t.guildid, t.userid) AS m
+            """,
+            keys,
+            fetch=True
+        )
+    # The rows have been deleted, remove them from the current sessions cache
+    for key in keys:
+        current_sessions.row_cache.pop(key, None)
+    # Use the function output to update the member cache
+    tables.lions._make_rows(*rows)
+
+
 @session_history.save_query
 def study_time_since(guildid, userid, timestamp):
     """
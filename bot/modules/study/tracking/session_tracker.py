@@ -1,9 +1,10 @@
+import heapq
 import asyncio
 import discord
 import logging
 import traceback
-from typing import Dict
-from collections import defaultdict
+from time import monotonic
+from typing import Dict, Tuple
 
 from utils.lib import utc_now
 from data import tables
@@ -16,6 +17,93 @@ from .data import current_sessions, SessionChannelType
 from .settings import untracked_channels, hourly_reward, hourly_live_bonus
 
 
+# Session channel types, bound once for the session start path
+_STANDARD = SessionChannelType.STANDARD
+_RENTED = SessionChannelType.RENTED
+_ACCOUNTABILITY = SessionChannelType.ACCOUNTABILITY
+
+# Session timers, dispatched by a single `_timer_loop`
+_timers = []  # Heap of (timestamp, guildid, userid, action)
+_timer_keys = {}  # (guildid, userid, action) -> timestamp of the live timer
+_timer_wakeup: asyncio.Event = None  # Set when a timer is scheduled ahead of the current earliest timer
+
+
+def _schedule_timer(guildid, userid, action, delay):
+    """
+    Schedule the given session `action` to run for the member after `delay` seconds.
+    Replaces any existing timer for the same member and action.
+    """
+    timestamp = monotonic() + delay
+    _timer_keys[(guildid, userid, action)] = timestamp
+    heapq.heappush(_timers, (timestamp, guildid, userid, action))
+    _compact_timers()
+    if _timers[0][0] == timestamp and _timer_wakeup is not None:
+        _timer_wakeup.set()
+
+
+def _cancel_timer(guildid, userid, action):
+    """
+    Cancel the given session action for the member, if it is scheduled.
+    The heap entry is left in place, and discarded when it expires or the heap is compacted.
+    """
+    _timer_keys.pop((guildid, userid, action), None)
+    _compact_timers()
+
+
+def _compact_timers():
+    """
+    Drop the cancelled and replaced entries from the timer heap once they outnumber the live timers.
+    Rescheduled expiries may otherwise accumulate for up to a day before they are discarded.
+    """
+    if len(_timers) > 2 * len(_timer_keys) + 64:
+        _timers[:] = [entry for entry in _timers if _timer_keys.get(entry[1:], None) == entry[0]]
+        heapq.heapify(_timers)
+
+
+async def _timer_loop():
+    """
+    Run the session timers as they expire.
+    """
+    while True:
+        timeout = (_timers[0][0] - monotonic()) if _timers else None
+        if timeout is None or timeout > 0:
+            # Wait for the earliest timer, or for an earlier timer to be scheduled
+            _timer_wakeup.clear()
+            try:
+                await asyncio.wait_for(_timer_wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        timestamp, guildid, userid, action = heapq.heappop(_timers)
+        key = (guildid, userid, action)
+        if _timer_keys.get(key, None) != timestamp:
+            # Timer was cancelled or rescheduled
+            continue
+        _timer_keys.pop(key)
+
+        try:
+            if action == 'expire':
+                if session := Session.get(guildid, userid):
+                    session._expire()
+            elif action == 'start':
+                if args := Session.members_pending.pop((guildid, userid), None):
+                    Session.start(*args)
+        except Exception:
+            # Unknown exception. Catch it so the loop doesn't die.
+            client.log(
+                "Error while running session timer '{}' for (uid:{}) in (gid:{})! "
+                "Exception traceback follows.\n{}".format(
+                    action,
+                    userid,
+                    guildid,
+                    traceback.format_exc()
+                ),
+                context="SESSION_TRACKER",
+                level=logging.ERROR
+            )
+
+
 class Session:
     """
     A `Session` describes an ongoing study session by a single guild member.
@@ -26,19 +114,26 @@ class Session:
     __slots__ = (
         'guildid',
         'userid',
-        '_expiry_task'
+        '_lion',
+        '_row',
     )
     # Global cache of ongoing sessions
-    sessions: Dict[int, Dict[int, 'Session']] = defaultdict(dict)
+    sessions: Dict[Tuple[int, int], 'Session'] = {}  # (guildid, userid) -> Session
 
     # Global cache of members pending session start (waiting for daily cap reset)
-    members_pending: Dict[int, Dict[int, asyncio.Task]] = defaultdict(dict)
+    # Maps to the arguments to start the session with
+    members_pending: Dict[Tuple[int, int], tuple] = {}  # (guildid, userid) -> (member, state)
 
-    def __init__(self, guildid, userid):
+    def __init__(self, guildid, userid, lion=None):
         self.guildid = guildid
         self.userid = userid
 
-        self._expiry_task: asyncio.Task = None
+        # Lions don't expire, so the member may be cached for the life of the session
+        # Fetched lazily, since sessions closed on startup never need it
+        self._lion = lion
+
+        # Cached `current_sessions` row, set while the session is active
+        self._row = None
 
     @classmethod
     def get(cls, guildid, userid):
@@ -46,7 +141,7 @@ class Session:
         Fetch the current session for the provided member.
         If there is no current session, returns `None`.
         """
-        return cls.sessions[guildid].get(userid, None)
+        return cls.sessions.get((guildid, userid), None)
 
     @classmethod
     def start(cls, member: discord.Member, state: discord.VoiceState):
@@ -55,17 +150,14 @@ class Session:
         """
         guildid = member.guild.id
         userid = member.id
-        now = utc_now()
 
-        if userid in cls.sessions[guildid]:
+        if (guildid, userid) in cls.sessions:
             raise ValueError("A session for this member already exists!")
 
         # If the user is study capped, schedule the session start for the next day
         if (lion := Lion.fetch(guildid, userid)).remaining_study_today <= 10:
-            if pending := cls.members_pending[guildid].pop(userid, None):
-                pending.cancel()
-            task = asyncio.create_task(cls._delayed_start(guildid, userid, member, state))
-            cls.members_pending[guildid][userid] = task
+            cls.members_pending[(guildid, userid)] = (member, state)
+            _schedule_timer(guildid, userid, 'start', lion.remaining_in_day)
             client.log(
                 "Member (uid:{}) in (gid:{}) is study capped, "
                 "delaying session start for {} seconds until start of next day.".format(
@@ -76,18 +168,22 @@ class Session:
             )
             return
 
+        now = utc_now()
+
         # TODO: More reliable channel type determination
-        if state.channel.id in tables.rented.row_cache:
-            channel_type = SessionChannelType.RENTED
-        elif state.channel.category and state.channel.category.id == lion.guild_settings.accountability_category.data:
-            channel_type = SessionChannelType.ACCOUNTABILITY
+        channelid = state.channel.id
+        categoryid = state.channel.category_id
+        if channelid in tables.rented.row_cache:
+            channel_type = _RENTED
+        elif categoryid and categoryid == lion.guild_settings.accountability_category.data:
+            channel_type = _ACCOUNTABILITY
         else:
-            channel_type = SessionChannelType.STANDARD
+            channel_type = _STANDARD
 
         current_sessions.create_row(
             guildid=guildid,
             userid=userid,
-            channelid=state.channel.id,
+            channelid=channelid,
             channel_type=channel_type,
             start_time=now,
             live_start=now if (state.self_video or state.self_stream) else None,
@@ -96,23 +192,13 @@ class Session:
             hourly_coins=hourly_reward.get(guildid).value,
             hourly_live_coins=hourly_live_bonus.get(guildid).value
         )
-        session = cls(guildid, userid).activate()
+        session = cls(guildid, userid, lion=lion).activate()
         client.log(
             "Started session: {}".format(session.data),
             context="SESSION_TRACKER",
             level=logging.DEBUG,
         )
 
-    @classmethod
-    async def _delayed_start(cls, guildid, userid, *args):
-        delay = Lion.fetch(guildid, userid).remaining_in_day
-        try:
-            await asyncio.sleep(delay)
-        except asyncio.CancelledError:
-            pass
-        else:
-            cls.start(*args)
-
     @property
     def key(self):
         """
@@ -125,14 +211,16 @@ class Session:
         """
         The Lion member object associated with this member.
         """
-        return Lion.fetch(self.guildid, self.userid)
+        if self._lion is None:
+            self._lion = Lion.fetch(self.guildid, self.userid)
+        return self._lion
 
     @property
     def data(self):
         """
         Row of the `current_sessions` table corresponding to this session.
         """
-        return current_sessions.fetch(self.key)
+        return self._row
 
     @property
     def duration(self):
@@ -147,11 +235,12 @@ class Session:
         Number of coins earned so far.
         """
         data = self.data
+        now = utc_now()
 
-        coins = self.duration * data.hourly_coins
+        coins = (now - data.start_time).total_seconds() * data.hourly_coins
         coins += data.live_duration * data.hourly_live_coins
         if data.live_start:
-            coins += (utc_now() - data.live_start).total_seconds() * data.hourly_live_coins
+            coins += (now - data.live_start).total_seconds() * data.hourly_live_coins
         return coins // 3600
 
     def activate(self):
@@ -161,7 +250,10 @@ class Session:
         and schedules the session expiry, based on the daily study cap.
         """
         # Add to the active cache
-        self.sessions[self.guildid][self.userid] = self
+        self.sessions[self.key] = self
+
+        # Cache the session row, which is updated in place while the session is ongoing
+        self._row = current_sessions.fetch(self.key)
 
         # Schedule the session expiry
         self.schedule_expiry()
@@ -172,36 +264,26 @@ class Session:
     def schedule_expiry(self):
         """
         Schedule session termination when the user reaches the maximum daily study time.
+        Replaces any existing expiry.
         """
-        asyncio.create_task(self._schedule_expiry())
+        _schedule_timer(self.guildid, self.userid, 'expire', self.lion.remaining_study_today)
 
-    async def _schedule_expiry(self):
-        # Cancel any existing expiry
-        if self._expiry_task and not self._expiry_task.done():
-            self._expiry_task.cancel()
-
-        # Wait for the maximum session length
-        self._expiry_task = asyncio.create_task(asyncio.sleep(self.lion.remaining_study_today))
-        try:
-            await self._expiry_task
-        except asyncio.CancelledError:
-            pass
+    def _expire(self):
+        if self.lion.remaining_study_today <= 10:
+            # End the session
+            # Note that the user will not automatically start a new session when the day starts
+            # TODO: Notify user? Disconnect them?
+            client.log(
+                "Session for (uid:{}) in (gid:{}) reached daily guild study cap.\n{}".format(
+                    self.userid, self.guildid, self.data
+                ),
+                context="SESSION_TRACKER"
+            )
+            self.finish()
         else:
-            if self.lion.remaining_study_today <= 10:
-                # End the session
-                # Note that the user will not automatically start a new session when the day starts
-                # TODO: Notify user? Disconnect them?
-                client.log(
-                    "Session for (uid:{}) in (gid:{}) reached daily guild study cap.\n{}".format(
-                        self.userid, self.guildid, self.data
-                    ),
-                    context="SESSION_TRACKER"
-                )
-                self.finish()
-            else:
-                # It's possible the expiry time was pushed forwards while waiting
-                # If so, reschedule
-                self.schedule_expiry()
+            # It's possible the expiry time was pushed forwards while waiting
+            # If so, reschedule
+            self.schedule_expiry()
 
     def finish(self):
         """
@@ -210,17 +292,31 @@ class Session:
         # Note that save_live_status doesn't need to be called here
         # The database saving procedure will account for the values.
         current_sessions.queries.close_study_session(*self.key)
+        self._deactivate()
+
+    @classmethod
+    def finish_many(cls, sessions):
+        """
+        Close the given study sessions with a single query.
+        """
+        current_sessions.queries.close_study_sessions(*(session.key for session in sessions))
+        for session in sessions:
+            session._deactivate()
 
+    def _deactivate(self):
         # Remove session from active cache
-        self.sessions[self.guildid].pop(self.userid, None)
+        self.sessions.pop(self.key, None)
 
-        # Cancel any existing expiry task
-        if self._expiry_task and not self._expiry_task.done():
-            self._expiry_task.cancel()
+        # Release the closed session row
+        self._row = None
+
+        # Cancel any existing expiry
+        _cancel_timer(self.guildid, self.userid, 'expire')
 
-    def save_live_status(self, state: discord.VoiceState):
+    def save_live_status(self, state: discord.VoiceState, changed_video=True, changed_stream=True):
         """
         Update the saved live status of the member.
+        `changed_video` and `changed_stream` restrict the update to the live statuses that changed.
         """
         has_video = state.self_video
         has_stream = state.self_stream
@@ -231,19 +327,22 @@ class Session:
 
         with data.batch_update():
             # Update video session stats
-            if data.video_start:
-                data.video_duration += (now - data.video_start).total_seconds()
-            data.video_start = now if has_video else None
+            if changed_video:
+                if data.video_start:
+                    data.video_duration += (now - data.video_start).total_seconds()
+                data.video_start = now if has_video else None
 
             # Update stream session stats
-            if data.stream_start:
-                data.stream_duration += (now - data.stream_start).total_seconds()
-            data.stream_start = now if has_stream else None
+            if changed_stream:
+                if data.stream_start:
+                    data.stream_duration += (now - data.stream_start).total_seconds()
+                data.stream_start = now if has_stream else None
 
-            # Update overall live session stats
-            if data.live_start:
-                data.live_duration += (now - data.live_start).total_seconds()
-            data.live_start = now if is_live else None
+            # Update overall live session stats, if the member went live or stopped being live
+            if bool(data.live_start) != is_live:
+                if data.live_start:
+                    data.live_duration += (now - data.live_start).total_seconds()
+                data.live_start = now if is_live else None
 
 
 async def session_voice_tracker(client, member, before, after):
@@ -254,14 +353,17 @@ async def session_voice_tracker(client, member, before, after):
         return
 
     guild = member.guild
-    Lion.fetch(guild.id, member.id).update_saved_data(member)
     session = Session.get(guild.id, member.id)
+    if session:
+        session.lion.update_saved_data(member)
 
     if before.channel == after.channel:
         # Voice state change without moving channel
-        if session and ((before.self_video != after.self_video) or (before.self_stream != after.self_stream)):
+        changed_video = before.self_video != after.self_video
+        changed_stream = before.self_stream != after.self_stream
+        if session and (changed_video or changed_stream):
             # Live status has changed!
-            session.save_live_status(after)
+            session.save_live_status(after, changed_video=changed_video, changed_stream=changed_stream)
     else:
         # Member changed channel
         # End the current session and start a new one, if applicable
@@ -291,7 +393,8 @@ async def session_voice_tracker(client, member, before, after):
             )
             # End the current session
             session.finish()
-        elif pending := Session.members_pending[guild.id].pop(member.id, None):
+        elif Session.members_pending.pop((guild.id, member.id), None):
+            _cancel_timer(guild.id, member.id, 'start')
             client.log(
                 "Cancelling pending study session for {member.name} (uid:{member.id}) "
                 "in {member.guild.name} (gid:{member.guild.id}) since they left the voice channel.".format(
@@ -300,16 +403,13 @@ async def session_voice_tracker(client, member, before, after):
                 context="SESSION_TRACKER",
                 post=False
             )
-            pending.cancel()
 
         if after.channel:
-            blacklist = client.user_blacklist()
-            guild_blacklist = client.objects['ignored_members'][guild.id]
-            untracked = untracked_channels.get(guild.id).data
+            # Short-circuit, so the blacklists are only consulted for tracked channels
             start_session = (
-                (after.channel.id not in untracked)
-                and (member.id not in blacklist)
-                and (member.id not in guild_blacklist)
+                (after.channel.id not in untracked_channels.get(guild.id).data)
+                and (member.id not in client.user_blacklist())
+                and (member.id not in client.objects['ignored_members'][guild.id])
             )
             if start_session:
                 # Start a new session for the member
@@ -321,6 +421,7 @@ async def session_voice_tracker(client, member, before, after):
                     context="SESSION_TRACKER",
                     post=False
                 )
+                Lion.fetch(guild.id, member.id).update_saved_data(member)
                 session = Session.start(member, after)
 
 
@@ -329,9 +430,9 @@ async def leave_guild_sessions(client, guild):
     `guild_leave` hook.
     Close all sessions in the guild when we leave.
     """
-    sessions = list(Session.sessions[guild.id].values())
-    for session in sessions:
-        session.finish()
+    sessions = [session for session in Session.sessions.values() if session.guildid == guild.id]
+    if sessions:
+        Session.finish_many(sessions)
     client.log(
         "Left {} (gid:{}) and closed {} ongoing study sessions.".format(guild.name, guild.id, len(sessions)),
         context="SESSION_TRACKER"
@@ -348,12 +449,14 @@ async def join_guild_sessions(client, guild):
     current_sessions.delete_where(guildid=guild.id)
 
     untracked = untracked_channels.get(guild.id).data
-    members = [
-        member
-        for channel in guild.voice_channels
-        for member in channel.members
-        if channel.members and channel.id not in untracked and not member.bot
-    ]
+    blacklist = client.user_blacklist() | client.objects['ignored_members'][guild.id]
+    members = []
+    for channel in guild.voice_channels:
+        if channel.id in untracked:
+            continue
+        for member in channel.members:
+            if not member.bot and member.id not in blacklist:
+                members.append(member)
     for member in members:
         client.log(
             "Starting new session for '{}' (uid: {}) in '{}' (cid: {}) of '{}' (gid: {})".format(
@@ -400,7 +503,7 @@ async def _init_session_tracker(client):
         level=logging.DEBUG
     )
     resumed = 0
-    ended = 0
+    ended = []
 
     # Grab all ongoing sessions from data
     rows = current_sessions.fetch_rows_where(guildid=THIS_SHARD)
@@ -433,8 +536,7 @@ async def _init_session_tracker(client):
                         context="SESSION_INIT",
                         level=logging.DEBUG
                     )
-                    session.finish()
-                    ended += 1
+                    ended.append(session)
             except Exception:
                 # Fatal error
                 client.log(
@@ -445,45 +547,61 @@ async def _init_session_tracker(client):
                 module.ready = False
                 return
 
+    # Close the completed sessions together
+    if ended:
+        try:
+            Session.finish_many(ended)
+        except Exception:
+            # Fatal error
+            client.log(
+                "Fatal error occurred ending completed sessions.\n{}".format(traceback.format_exc()),
+                context="SESSION_INIT",
+                level=logging.CRITICAL
+            )
+            module.ready = False
+            return
+
     # Log resumed sessions
     client.log(
-        "Resumed {} ongoing study sessions, and ended {}.".format(resumed, ended),
+        "Resumed {} ongoing study sessions, and ended {}.".format(resumed, len(ended)),
         context="SESSION_INIT",
         level=logging.INFO
     )
 
     # Now iterate through members of all tracked voice channels
     # Start sessions if they don't already exist
-    tracked_channels = [
-        channel
-        for guild in client.guilds
-        for channel in guild.voice_channels
-        if channel.members and channel.id not in untracked_channels.get(guild.id).data
-    ]
-    new_members = [
-        member
-        for channel in tracked_channels
-        for member in channel.members
-        if not member.bot and not Session.get(member.guild.id, member.id)
-    ]
-    for member in new_members:
-        client.log(
-            "Starting new session for '{}' (uid: {}) in '{}' (cid: {}) of '{}' (gid: {})".format(
-                member.name,
-                member.id,
-                member.voice.channel.name,
-                member.voice.channel.id,
-                member.guild.name,
-                member.guild.id
-            ),
-            context="SESSION_INIT",
-            level=logging.DEBUG
-        )
-        Session.start(member, member.voice)
+    blacklist = client.user_blacklist()
+    ignored_members = client.objects['ignored_members']
+    started = 0
+    for guild in client.guilds:
+        untracked = untracked_channels.get(guild.id).data
+        guild_ignored = ignored_members[guild.id]
+        for channel in guild.voice_channels:
+            if channel.id in untracked:
+                continue
+            for member in channel.members:
+                if member.bot or member.id in blacklist or member.id in guild_ignored:
+                    continue
+                if Session.get(guild.id, member.id):
+                    continue
+                client.log(
+                    "Starting new session for '{}' (uid: {}) in '{}' (cid: {}) of '{}' (gid: {})".format(
+                        member.name,
+                        member.id,
+                        channel.name,
+                        channel.id,
+                        guild.name,
+                        guild.id
+                    ),
+                    context="SESSION_INIT",
+                    level=logging.DEBUG
+                )
+                Session.start(member, member.voice)
+                started += 1
 
     # Log newly started sessions
     client.log(
-        "Started {} new study sessions from current voice channel members.".format(len(new_members)),
+        "Started {} new study sessions from current voice channel members.".format(started),
         context="SESSION_INIT",
         level=logging.INFO
     )
@@ -500,5 +618,10 @@ async def launch_session_tracker(client):
     Launch the study session initialiser.
     Doesn't block on the client being ready.
     """
+    global _timer_wakeup
+
     client.objects['sessions'] = Session.sessions
+
+    _timer_wakeup = asyncio.Event()
+    asyncio.create_task(_timer_loop())
     asyncio.create_task(_init_session_tracker(client))
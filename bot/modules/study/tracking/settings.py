@@ -1,3 +1,5 @@
+from cachetools import LRUCache
+
 import settings
 from settings import GuildSettings
 from wards import guild_admin
@@ -27,8 +29,8 @@ class untracked_channels(settings.ChannelList, settings.ListData, settings.Setti
         "Time spent in these voice channels won't add study time or lioncoins to the member."
     )
 
-    # Flat cache, no need to expire objects
-    _cache = {}
+    # Flat cache, evicting the least recently used guilds
+    _cache = LRUCache(8192)
 
     @property
     def success_response(self):
@@ -84,6 +86,9 @@ class hourly_reward(settings.Integer, settings.GuildSetting):
     )
     _accepts = "An integer number of LionCoins to reward."
 
+    # Flat cache, evicting the least recently used guilds
+    _cache = LRUCache(8192)
+
     @property
     def success_response(self):
         return "Members will be rewarded `{}` LionCoins per hour of study.".format(self.formatted)
@@ -108,6 +113,9 @@ class hourly_live_bonus(settings.Integer, settings.GuildSetting):
     )
     _accepts = "An integer number of LionCoins to reward."
 
+    # Flat cache, evicting the least recently used guilds
+    _cache = LRUCache(8192)
+
     @property
     def success_response(self):
         return "Members will be rewarded an extra `{}` LionCoins per hour if they stream.".format(self.formatted)
@@ -138,6 +146,10 @@ class daily_study_cap(settings.Duration, settings.GuildSetting):
     @property
     def success_response(self):
         # Refresh expiry for all sessions in the guild
-        [session.schedule_expiry() for session in self.client.objects['sessions'][self.id].values()]
+        [
+            session.schedule_expiry()
+            for session in self.client.objects['sessions'].values()
+            if session.guildid == self.id
+        ]
 
         return "The maximum tracked daily study time is now {}.".format(self.formatted)
@@ -1,3 +1,5 @@
+from cachetools import LRUCache
+
 from settings import GuildSettings, GuildSetting
 import settings
 
@@ -93,8 +95,8 @@ class tasklist_channels_setting(settings.ChannelList, settings.ListData, setting
         "Members will only be allowed to use the `todo` command in these channels."
     )
 
-    # Flat cache, no need to expire objects
-    _cache = {}
+    # Flat cache, evicting the least recently used guilds
+    _cache = LRUCache(8192)
 
     @property
     def success_response(self):
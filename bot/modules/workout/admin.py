@@ -1,3 +1,5 @@
+from cachetools import LRUCache
+
 from settings import GuildSettings, GuildSetting
 from wards import guild_admin
 
@@ -72,8 +74,8 @@ class workout_channels_setting(settings.ChannelList, settings.ListData, settings
         "Sessions in these channels will be treated as workouts."
     )
 
-    # Flat cache, no need to expire objects
-    _cache = {}
+    # Flat cache, evicting the least recently used guilds
+    _cache = LRUCache(8192)
 
     @property
     def success_response(self):
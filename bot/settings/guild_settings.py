@@ -1,6 +1,7 @@
 import datetime
 import asyncio
 import discord
+from cachetools import LRUCache
 
 import settings
 from utils.lib import DotDict
@@ -128,8 +129,8 @@ class unranked_roles(settings.RoleList, settings.ListData, settings.Setting):
         "Roles to be excluded from the `top` and `topcoins` leaderboards."
     )
 
-    # Flat cache, no need to expire objects
-    _cache = {}
+    # Flat cache, evicting the least recently used guilds
+    _cache = LRUCache(8192)
 
     @property
     def success_response(self):
@@ -159,8 +160,8 @@ class donator_roles(settings.RoleList, settings.ListData, settings.Setting):
         "Members with these roles will be considered donators and have access to premium features."
     )
 
-    # Flat cache, no need to expire objects
-    _cache = {}
+    # Flat cache, evicting the least recently used guilds
+    _cache = LRUCache(8192)
 
     @property
     def success_response(self):
@@ -539,7 +539,7 @@ def utc_now():
     """
     Return the current timezone-aware utc timestamp.
     """
-    return datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
+    return datetime.datetime.now(datetime.timezone.utc)
 
 
 def multiple_replace(string, rep_dict):